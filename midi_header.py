@@ -19,9 +19,12 @@
 
 __version__ = '0.1'
 
-import mido, os, pandas as pd, re, sys
+import csv, functools as ft, os, pandas as pd, sys
 import multiprocessing as mp, multiprocessing.pool as mppool
 
+# shared file discovery and loading
+from midi_yamaha_modus_convert import iter_midi_paths, midi_read
+
 headers_default: list = [
     'filename',
     'track_name',
@@ -38,10 +41,9 @@ headers_attr: dict = {
     'copyright': 'text',
 }
 
-midi_re: re.Pattern = re.compile(r'\.midi?$',re.IGNORECASE)
-
 field_sep: str = '\t'
 multi_sep: str = '; '
+chunksize: int = 8
 
 control_and_program_change_types: set = {
     'control_change',
@@ -51,16 +53,27 @@ control_and_program_change_types: set = {
 def midi_display_header(midi_filepath: str,
         headers: list=headers_default,
         multi_sep: str=multi_sep) -> list:
-    mid = mido.MidiFile(midi_filepath)
-    # convert from MIDI type 1 to type 0
-    track = mido.merge_tracks(mid.tracks)
-    header_messages = []
-    for msg in track:
-        if hasattr(msg,'channel') \
-                and not msg.type in control_and_program_change_types:
-            break
-        else:
-            header_messages.append(msg)
+    # only header text is read, so clip out-of-range data bytes rather than fail
+    mid = midi_read(midi_filepath, clip=True)
+    # read each track's prefix up to its first channel message instead of
+    # merging all tracks; (absolute time, track, index) reproduces the
+    # merge_tracks order, and the earliest first channel message ends the header
+    first_channel = None
+    prefix_messages = []
+    for k, track in enumerate(mid.tracks):
+        abstime = 0
+        for j, msg in enumerate(track):
+            abstime += msg.time
+            order = (abstime, k, j)
+            if first_channel is not None and order > first_channel:
+                break
+            if hasattr(msg,'channel') \
+                    and not msg.type in control_and_program_change_types:
+                first_channel = order
+                break
+            prefix_messages.append((order, msg))
+    header_messages = [msg for order, msg in sorted(prefix_messages, key=lambda x: x[0])
+        if first_channel is None or order < first_channel]
     header_values = []
     for hdr in headers:
         if hasattr(mid, hdr): val = getattr(mid, hdr)
@@ -68,30 +81,50 @@ def midi_display_header(midi_filepath: str,
         header_values.append(val)
     return header_values
 
+def midi_display_header_rows(names: list,
+        headers: list=headers_default,
+        multi_sep: str=multi_sep,
+        chunksize: int=chunksize):
+    worker = ft.partial(midi_display_header, headers=headers, multi_sep=multi_sep)
+    n_workers = max(1, mp.cpu_count()-2)
+    # mido parsing is CPU-bound Python, so threads don't help; skip the
+    # process pool when it can't run anything in parallel
+    if n_workers == 1 or (len(names) == 1 and os.path.isfile(names[0])):
+        yield from map(worker, iter_midi_paths(names))
+        return
+    # the with block terminates the workers if the caller stops early or a worker raises
+    with mppool.Pool(n_workers) as pool:
+        yield from pool.imap(worker, iter_midi_paths(names), chunksize=chunksize)
+        pool.close()
+        pool.join()
+
 def midi_display_header_in_names(names: list,
         headers: list=headers_default,
         field_sep: str=field_sep,
-        multi_sep: str=multi_sep) -> pd.core.frame.DataFrame:
-    midi_headers = []
-    if len(names) == 1 and os.path.isfile(names[0]):
-        midi_headers.append(midi_display_header(names[0]))
-    else:
-        all_filepaths = []
-        for name in names:
-            if os.path.isfile(name):
-                all_filepaths.append(name)
-            elif os.path.isdir(name):
-                for root, directories, files in os.walk(name):
-                    for file in [f for f in files if bool(midi_re.findall(f))]:
-                        all_filepaths.append(os.path.join(root, file))
-    pool = mppool.Pool(mp.cpu_count()-2)
-    midi_headers += pool.starmap(midi_display_header,[(fp, headers, multi_sep) for fp in all_filepaths])
-    pool.close()
-    pool.join()
-    df_midi = pd.DataFrame(midi_headers, columns=headers)
+        multi_sep: str=multi_sep,
+        chunksize: int=chunksize) -> pd.core.frame.DataFrame:
+    midi_headers = {hdr: [] for hdr in headers}
+    # build the DataFrame column-wise as rows arrive
+    for row in midi_display_header_rows(names, headers, multi_sep, chunksize):
+        for hdr, val in zip(headers, row):
+            midi_headers[hdr].append(val)
+    df_midi = pd.DataFrame(midi_headers, columns=headers, copy=False)
     return df_midi
 
+def midi_write_header_in_names(names: list,
+        file=None,
+        headers: list=headers_default,
+        field_sep: str=field_sep,
+        multi_sep: str=multi_sep,
+        chunksize: int=chunksize):
+    # resolve stdout at call time so a redirected sys.stdout is honored
+    if file is None: file = sys.stdout
+    # stream rows as they arrive, without building a DataFrame
+    writer = csv.writer(file, delimiter=field_sep, lineterminator='\n')
+    writer.writerow(headers)
+    for row in midi_display_header_rows(names, headers, multi_sep, chunksize):
+        writer.writerow(row)
+
 if __name__=='__main__':
     if len(sys.argv) > 1:
-        df_midi = midi_display_header_in_names(sys.argv[1:],headers=headers_default)
-        print(df_midi.to_csv(sep=field_sep, index=False))
+        midi_write_header_in_names(sys.argv[1:],headers=headers_default)
@@ -22,15 +22,47 @@
 
 __version__ = '0.1'
 
-import argparse as ap, dataclasses as dc, mido, os, re, sys
+import argparse as ap, dataclasses as dc, functools as ft, io, mido, os, re, sys
 import multiprocessing as mp, multiprocessing.pool as mppool
 
 midi_re: re.Pattern = re.compile(r'^(.+)(\.midi?)$',re.IGNORECASE)
+# lowercase MIDI filename suffixes, matched with str.endswith
+midi_suffixes: tuple = ('.mid','.midi',)
 suffix_default = '_modus'
+chunksize_default = 8
+
+def _true(msg) -> bool: return True
+def _false(msg) -> bool: return False
 
 # Yamaha Clavinova / Modus F, H MIDI format
 # https://usa.yamaha.com/files/download/other_assets/4/335434/f11_en_de_fr_es_dl_a0_v100.pdf
 
+# modus initial tempo messages
+modus_initial_tempo_messages_default: tuple = (
+    mido.midifiles.meta.MetaMessage(type='set_tempo', tempo=600000, time=0),
+    mido.midifiles.meta.MetaMessage(type='time_signature', numerator=4, denominator=4, clocks_per_click=24, notated_32nd_notes_per_beat=8, time=0),
+)
+
+# modus sequencer_specific messages
+modus_sequencer_specific_default: tuple = (
+    mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 123, 0, 88, 70, 48, 50, 0, 27),time=0),
+    mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 113, 0, 1, 0, 1, 0),time=0),
+    mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 113, 0, 0, 0, 65),time=0),
+    mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 123, 12, 1, 0),time=0),
+)
+
+# modus control and program changes
+modus_control_and_program_changes_default: tuple = (
+    mido.Message(type='control_change', channel=0, control=0, value=0, time=960),
+    mido.Message(type='control_change', channel=0, control=32, value=0, time=10),
+    mido.Message(type='program_change', channel=0, program=0, time=10),
+    mido.Message(type='control_change', channel=0, control=7, value=127, time=10),
+    mido.Message(type='control_change', channel=0, control=11, value=127, time=10),
+    mido.Message(type='control_change', channel=0, control=10, value=64, time=10),
+    mido.Message(type='control_change', channel=0, control=91, value=22, time=10),
+    mido.Message(type='control_change', channel=0, control=93, value=0, time=10),
+)
+
 @dc.dataclass
 class YamahaModusMIDI:
     """Adapted from the Yamaha Modus F11, F01 Data List,
@@ -56,8 +88,8 @@ class YamahaModusMIDI:
         find ./midi-files-modus -type f -iname '*.mid' | perl -MList::Util=shuffle -wne 'print shuffle <>;' | head -990 | xargs -I{} cp {} /Volumes/USB
     """
 
-    range15: set = dc.field(default_factory=lambda: {k for k in range(0,16)})
-    range127: set = dc.field(default_factory=lambda: {k for k in range(0,128)})
+    range15: set = dc.field(default_factory=lambda: set(range(0,16)))
+    range127: set = dc.field(default_factory=lambda: set(range(0,128)))
     f7_hex = int('f7',16)
 
     # page 9
@@ -71,7 +103,7 @@ class YamahaModusMIDI:
         123: {0,},
         124: {0,},
         125: {0,},
-        126: {k for k in range(0,17)},
+        126: set(range(0,17)),
         127: {0,},
     })
     pitchwheel: bool = True
@@ -100,12 +132,10 @@ class YamahaModusMIDI:
     sysex_general_midi_mode_on: str = 'F0 7E 7F 09 01 F7'
     sysex_xg_native_parameter_change: str = 'F0 43 1F 4C 7F 7F 7F 7F F7'
     sysex_xg_native_bulk_data: str = 'F0 43 0F 4C 7F 7F 7F 7F 7F'
+    sysex_xg_system_on: str = 'F0 43 10 4C 00 00 7E 00 F7'
 
     # modus initial tempo messages
-    modus_initial_tempo_messages: list = dc.field(default_factory=lambda: [
-        mido.midifiles.meta.MetaMessage(type='set_tempo', tempo=600000, time=0),
-        mido.midifiles.meta.MetaMessage(type='time_signature', numerator=4, denominator=4, clocks_per_click=24, notated_32nd_notes_per_beat=8, time=0),
-    ])
+    modus_initial_tempo_messages: list = dc.field(default_factory=lambda: list(modus_initial_tempo_messages_default))
 
     tempo_and_time_signature_types: set = dc.field(default_factory=lambda: {
         'set_tempo',
@@ -117,6 +147,18 @@ class YamahaModusMIDI:
         'program_change',
     })
 
+    # message types with a channel attribute, including the channel_prefix meta message
+    channel_types: set = dc.field(default_factory=lambda: {
+        'channel_prefix',
+        'note_off',
+        'note_on',
+        'polytouch',
+        'control_change',
+        'program_change',
+        'aftertouch',
+        'pitchwheel',
+    })
+
     control_and_program_change_and_sysex_types: set = dc.field(default_factory=lambda: {
         'control_change',
         'program_change',
@@ -126,24 +168,10 @@ class YamahaModusMIDI:
     copyright = None
 
     # modus sequencer_specific messages
-    modus_sequencer_specific: list = dc.field(default_factory=lambda: [
-        mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 123, 0, 88, 70, 48, 50, 0, 27),time=0),
-        mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 113, 0, 1, 0, 1, 0),time=0),
-        mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 113, 0, 0, 0, 65),time=0),
-        mido.midifiles.meta.MetaMessage(type='sequencer_specific',data=(67, 123, 12, 1, 0),time=0)
-    ])
+    modus_sequencer_specific: list = dc.field(default_factory=lambda: list(modus_sequencer_specific_default))
 
     # modus control and program changes
-    modus_control_and_program_changes: list = dc.field(default_factory=lambda: [
-        mido.Message(type='control_change', channel=0, control=0, value=0, time=960),
-        mido.Message(type='control_change', channel=0, control=32, value=0, time=10),
-        mido.Message(type='program_change', channel=0, program=0, time=10),
-        mido.Message(type='control_change', channel=0, control=7, value=127, time=10),
-        mido.Message(type='control_change', channel=0, control=11, value=127, time=10),
-        mido.Message(type='control_change', channel=0, control=10, value=64, time=10),
-        mido.Message(type='control_change', channel=0, control=91, value=22, time=10),
-        mido.Message(type='control_change', channel=0, control=93, value=0, time=10),
-    ])
+    modus_control_and_program_changes: list = dc.field(default_factory=lambda: list(modus_control_and_program_changes_default))
 
     # modus header omit these messages from the original
     modus_omit_header_messages: set = dc.field(default_factory=lambda: {
@@ -152,7 +180,7 @@ class YamahaModusMIDI:
     
     def __post_init__(self):
         self.zerox_re: re.Pattern = re.compile(r'^0x')
-        self.note_re: re.Pattern = re.compile(r'^note_(?:on|off)')
+        self._note_types: frozenset = frozenset({'note_on','note_off',})
         self.sysex_terminator_byte: int = self.f7_hex
 
         # page 9
@@ -195,162 +223,257 @@ class YamahaModusMIDI:
             self.sysex_gm2_system_on,
             self.sysex_xg_native_parameter_change,
         ]]
+        # modus sysex messages, added by hand after the header
+        self._modus_sysex_messages: tuple = (
+            self.message_from_str(self.sysex_gm1_system_on, time=0),
+            self.message_from_str(self.sysex_xg_system_on, time=960),
+        )
+        # split masks by terminator once: (terminated masks, unterminated prefix masks)
+        self._sysex_masks: tuple = self.split_byte_masks(self.sysex_byte_masks)
+        self._sysex_add_by_hand_masks: tuple = self.split_byte_masks(self.sysex_add_by_hand_byte_masks)
+
+        # meta message types and whether they are kept
+        self._meta_valid: dict = {
+            'sequence_number': True,
+            'text': True,
+            'copyright': True,
+            'track_name': True,
+            'instrument_name': True,
+            'lyrics': True,
+            'marker': True,
+            'cue_marker': False,
+            'device_name': True,
+            'channel_prefix': True,
+            'midi_port': True,
+            'end_of_track': True,
+            'set_tempo': True,
+            'smpte_offset': True,
+            'time_signature': True,
+            'key_signature': True,
+            'sequencer_specific': False,
+        }
+        # specialize is_valid_message to this instance's tables
+        self.is_valid_message = self._compile_validator()
+
+    # the compiled validator is a local closure: pickle without it and rebuild on load
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['is_valid_message']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.is_valid_message = self._compile_validator()
 
     def message_from_str(self, data_str: str, type: str='sysex', data_start: int=1, data_end: int=-1, time:int=0) -> mido.messages.messages.Message:
         return mido.Message(type=type, data=tuple(int(x,16) for x in data_str.split()[data_start:data_end]),time=time)
 
     def gm_system_on_exists(self, track: mido.midifiles.tracks.MidiTrack) -> bool:
-        return any([self.data_in_byte_masks(m.bytes(), self.sysex_add_by_hand_byte_masks) for m in track if m.type == 'sysex'])
-
-    def is_valid_message(self, msg):
-        valid_flag = False
-        if msg.is_meta:
-            if msg.type == 'sequence_number':
-                valid_flag = True
-            elif msg.type == 'text':
-                valid_flag = True
-            elif msg.type == 'copyright':
-                valid_flag = True
-            elif msg.type == 'track_name':
-                valid_flag = True
-            elif msg.type == 'instrument_name':
-                valid_flag = True
-            elif msg.type == 'lyrics':
-                valid_flag = True
-            elif msg.type == 'marker':
-                valid_flag = True
-            elif msg.type == 'cue_marker':
-                valid_flag = False
-            elif msg.type == 'device_name':
-                valid_flag = True
-            elif msg.type == 'channel_prefix':
-                valid_flag = True
-            elif msg.type == 'midi_port':
-                valid_flag = True
-            elif msg.type == 'end_of_track':
-                valid_flag = True
-            elif msg.type == 'set_tempo':
-                valid_flag = True
-            elif msg.type == 'smpte_offset':
-                valid_flag = True
-            elif msg.type == 'time_signature':
-                valid_flag = True
-            elif msg.type == 'key_signature':
-                valid_flag = True
-            elif msg.type == 'sequencer_specific':
-                valid_flag = False
-        else:
-            if bool(self.note_re.findall(msg.type)):
-                valid_flag = msg.note in self.note and msg.velocity in self.velocity
-            elif msg.type == 'polytouch':
-                valid_flag = True
-            elif msg.type == 'control_change':
-                valid_flag = msg.control in self.control_change \
-                    and msg.value in self.control_change[msg.control]
-            elif msg.type == 'program_change':
-                valid_flag = msg.program in self.program_change
-            elif msg.type == 'aftertouch':
-                valid_flag = msg.channel in self.aftertouch
-            elif msg.type == 'pitchwheel':
-                valid_flag = self.pitchwheel
-            elif msg.type == 'sysex':
-                valid_flag = not self.data_in_byte_masks(msg.bytes(),self.sysex_add_by_hand_byte_masks) \
-                    and self.data_in_byte_masks(msg.bytes(),self.sysex_byte_masks)
-        return valid_flag
-
-    def data_in_byte_masks(self, data, byte_masks) -> bool:
-        return any(len(data) == len(l) and not any(d & ~x for d, x in zip(data,l)) for l in byte_masks if l[-1] == self.sysex_terminator_byte) \
-            or any(not any(d & ~x for d, x in zip(data,l)) for l in byte_masks if l[-1] != 247)
+        return any([self.data_in_byte_masks(m.bytes(), self._sysex_add_by_hand_masks) for m in track if m.type == 'sysex'])
+
+    def _compile_validator(self):
+        # close over the validation tables so each call reads cell variables
+        # instead of instance attributes; fixed once __post_init__ has run
+        note, velocity = self.note, self.velocity
+        control_change, program_change = self.control_change, self.program_change
+        aftertouch, pitchwheel = self.aftertouch, self.pitchwheel
+        sysex_masks, sysex_add_by_hand_masks = self._sysex_masks, self._sysex_add_by_hand_masks
+        data_in_byte_masks = self.data_in_byte_masks
+        meta_valid = self._meta_valid
+
+        def valid_note(msg):
+            return msg.note in note and msg.velocity in velocity
+
+        def valid_control_change(msg):
+            values = control_change.get(msg.control)
+            return values is not None and msg.value in values
+
+        def valid_program_change(msg):
+            return msg.program in program_change
+
+        def valid_aftertouch(msg):
+            return msg.channel in aftertouch
+
+        def valid_pitchwheel(msg):
+            return pitchwheel
+
+        def valid_sysex(msg):
+            data = msg.bytes()
+            return not data_in_byte_masks(data,sysex_add_by_hand_masks) \
+                and data_in_byte_masks(data,sysex_masks)
+
+        chan_dispatch = {
+            **{t: valid_note for t in self._note_types},
+            'polytouch': _true,
+            'control_change': valid_control_change,
+            'program_change': valid_program_change,
+            'aftertouch': valid_aftertouch,
+            'pitchwheel': valid_pitchwheel,
+            'sysex': valid_sysex,
+        }
+
+        def is_valid_message(msg) -> bool:
+            if msg.is_meta:
+                return meta_valid.get(msg.type, False)
+            return chan_dispatch.get(msg.type, _false)(msg)
+
+        return is_valid_message
+
+    def split_byte_masks(self, byte_masks: list) -> tuple:
+        # (length, big-endian integer of the complemented mask bytes)
+        def complement(l): return len(l), int.from_bytes(bytes(0xFF ^ x for x in l),'big')
+        return [complement(l) for l in byte_masks if l[-1] == self.sysex_terminator_byte], \
+            [complement(l) for l in byte_masks if l[-1] != self.sysex_terminator_byte]
+
+    def data_in_byte_masks(self, data, split_masks: tuple) -> bool:
+        masks_term, masks_noterm = split_masks
+        n = len(data)
+        dint = int.from_bytes(bytes(data),'big')
+        # unterminated masks only check the overlapping prefix of data and mask
+        return any(n == ln and dint & comp == 0 for ln, comp in masks_term) \
+            or any(((dint >> 8*(n-ln)) & comp if n >= ln else dint & (comp >> 8*(ln-n))) == 0
+                for ln, comp in masks_noterm)
+
+def midi_read(midi_filepath: str, clip: bool=False) -> mido.midifiles.midifiles.MidiFile:
+    # read the whole file at once and let mido parse it byte by byte from memory
+    with open(midi_filepath, 'rb') as f:
+        return mido.MidiFile(filename=midi_filepath, file=io.BytesIO(f.read()), clip=clip)
+
+def midi_write(mid: mido.midifiles.midifiles.MidiFile, midi_filepath: str):
+    # serialize in memory, then hand the whole file to the kernel in one write
+    buf = io.BytesIO()
+    mid.save(file=buf)
+    data = memoryview(buf.getbuffer())
+    fd = os.open(midi_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+# per-process YamahaModusMIDI, built once by _init_worker
+_YMM: YamahaModusMIDI = None
+
+def _init_worker():
+    global _YMM
+    _YMM = YamahaModusMIDI()
 
 def midi_convert(midi_filepath: str, textlist: list=None,
                  suffix: str=suffix_default,
-                 ymm=YamahaModusMIDI(),
+                 ymm: YamahaModusMIDI=None,
                  debug: bool=False):
-    mid_orig = mido.MidiFile(midi_filepath)
+    if ymm is None:
+        if _YMM is None: _init_worker()
+        ymm = _YMM
+    # don't clip: out-of-range data bytes would be silently rewritten into the converted file
+    mid_orig = midi_read(midi_filepath)
     # convert from MIDI type 1 to type 0
     track_orig = mido.merge_tracks(mid_orig.tracks)
     mid_new = mido.MidiFile()
     if hasattr(mid_orig,'ticks_per_beat'):
         mid_new.ticks_per_beat = mid_orig.ticks_per_beat
-    track = mido.MidiTrack()
-    mid_new.tracks.append(track)
+    # collect the new track's messages in a plain list, then build the track once
+    messages = []
     before_channel_messages_flag = True
     tempo_and_time_signature_messages = []
     control_and_program_change_and_sysex_messages = []
     # Modus initial tempo messages
     if bool(ymm.modus_initial_tempo_messages):
-        for m in ymm.modus_initial_tempo_messages:
-            track.append(m)
+        messages.extend(ymm.modus_initial_tempo_messages)
+    meta_types = {m.type for m in track_orig if m.is_meta}
     # track_name
-    if len([m for m in track_orig if m.is_meta and m.type == 'track_name']) == 0:
+    if not 'track_name' in meta_types:
         track_name = midi_re.sub('\\1', os.path.basename(mid_orig.filename))
-        track.append(mido.midifiles.meta.MetaMessage(type='track_name', name=track_name, time=0))
+        messages.append(mido.midifiles.meta.MetaMessage(type='track_name', name=track_name, time=0))
     # copyright
-    if bool(ymm.copyright) and len([m for m in track_orig if m.is_meta and m.type == 'copyright']) == 0:
-        track.append(mido.midifiles.meta.MetaMessage(type='copyright',text=ymm.copyright,time=0))
+    if bool(ymm.copyright) and not 'copyright' in meta_types:
+        messages.append(mido.midifiles.meta.MetaMessage(type='copyright',text=ymm.copyright,time=0))
     # text
     if bool(textlist):
-        for text in textlist:
-            track.append(mido.midifiles.meta.MetaMessage(type='text',text=text,time=0))
+        messages.extend(mido.midifiles.meta.MetaMessage(type='text',text=text,time=0) for text in textlist)
+    # bind the per-message lookups once
+    omit_types = ymm.modus_omit_header_messages
+    tempo_types = ymm.tempo_and_time_signature_types
+    later_types = ymm.control_and_program_change_and_sysex_types
+    first_channel_types = ymm.channel_types - ymm.control_and_program_change_types
+    is_valid_message = ymm.is_valid_message
     for msg in track_orig:
-        # add these messages before the first channel information
-        if before_channel_messages_flag \
-                and msg.type in ymm.modus_omit_header_messages:
-            if debug: print(f'Omitted {msg}')
-            continue
-        # add tempo and time signature messages later
-        if before_channel_messages_flag \
-                and msg.type in ymm.tempo_and_time_signature_types:
-            tempo_and_time_signature_messages.append(msg)
-            continue
-        # add control and program change and sysex later
-        if before_channel_messages_flag \
-                and msg.type in ymm.control_and_program_change_and_sysex_types:
-            control_and_program_change_and_sysex_messages.append(msg)
-            continue
+        msg_type = msg.type
+        if before_channel_messages_flag:
+            # add these messages before the first channel information
+            if msg_type in omit_types:
+                if debug: print(f'Omitted {msg}')
+                continue
+            # add tempo and time signature messages later
+            if msg_type in tempo_types:
+                tempo_and_time_signature_messages.append(msg)
+                continue
+            # add control and program change and sysex later
+            if msg_type in later_types:
+                control_and_program_change_and_sysex_messages.append(msg)
+                continue
         if before_channel_messages_flag \
-                and hasattr(msg,'channel') \
-                and not msg.type in ymm.control_and_program_change_types:
+                and msg_type in first_channel_types:
             before_channel_messages_flag = False
             # add these messages by hand
             # Modus sequencer_specific
             if bool(ymm.modus_sequencer_specific):
-                for m in ymm.modus_sequencer_specific:
-                    track.append(m)
+                messages.extend(ymm.modus_sequencer_specific)
             # Modus sysex
-            track.append(ymm.message_from_str(ymm.sysex_gm1_system_on, time=0))
-            track.append(ymm.message_from_str('F0 43 10 4C 00 00 7E 00 F7', time=960))
+            messages.extend(ymm._modus_sysex_messages)
             # Modus control and program changes
             if bool(ymm.modus_control_and_program_changes):
-                for m in ymm.modus_control_and_program_changes:
-                    track.append(m)
+                messages.extend(ymm.modus_control_and_program_changes)
             # add tempo and time signature messages
-            for m in tempo_and_time_signature_messages:
-                if ymm.is_valid_message(m): track.append(m)
+            messages.extend(filter(is_valid_message, tempo_and_time_signature_messages))
             # add control and program change and sysex messages
-            for m in control_and_program_change_and_sysex_messages:
-                if ymm.is_valid_message(m): track.append(m)
-        if ymm.is_valid_message(msg): track.append(msg)
+            messages.extend(filter(is_valid_message, control_and_program_change_and_sysex_messages))
+        if is_valid_message(msg): messages.append(msg)
         elif debug: print(f'Omitted {msg}')
 
-    mid_new.save(midi_re.sub(f'\\1{suffix}\\2',midi_filepath))
-
-def midi_convert_in_names(names, textlist=None):
-    if len(names) == 1 and os.path.isfile(names[0]):
-        midi_convert(names[0], textlist=textlist)
+    mid_new.tracks.append(mido.MidiTrack(messages))
+    midi_write(mid_new, midi_re.sub(f'\\1{suffix}\\2',midi_filepath))
+
+def _scan_midi_paths(path: str):
+    # like os.walk: skip unreadable directories and don't follow directory symlinks
+    # read each directory fully before yielding, so files written into it
+    # while the generator is consumed aren't picked up
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
         return
-    all_filepaths = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan_midi_paths(entry.path)
+        elif entry.is_file() and entry.name.lower().endswith(midi_suffixes):
+            yield entry.path
+
+def iter_midi_paths(names: list):
     for name in names:
         if os.path.isfile(name):
-            all_filepaths.append(name)
+            yield name
         elif os.path.isdir(name):
-            for root, directories, files in os.walk(name):
-                for file in [f for f in files if bool(midi_re.findall(f))]:
-                    all_filepaths.append(os.path.join(root, file))
-    pool = mppool.Pool(mp.cpu_count()-2)
-    pool.starmap(midi_convert, [(filepath,textlist) for filepath in all_filepaths])
-    pool.close()
-    pool.join()
+            yield from _scan_midi_paths(name)
+
+def midi_convert_in_names(names, textlist=None, chunksize: int=chunksize_default):
+    if len(names) == 1 and os.path.isfile(names[0]):
+        midi_convert(names[0], textlist=textlist)
+        return
+    # walk everything before the first write so that converted output
+    # written into a directory being walked isn't converted again
+    filepaths = list(iter_midi_paths(names))
+    n_workers = max(1, mp.cpu_count()-2)
+    if n_workers == 1:
+        for filepath in filepaths:
+            midi_convert(filepath, textlist=textlist)
+        return
+    # the with block terminates the workers if a conversion raises
+    with mppool.Pool(n_workers, initializer=_init_worker) as pool:
+        for _ in pool.imap_unordered(ft.partial(midi_convert, textlist=textlist), filepaths, chunksize=chunksize):
+            pass
+        pool.close()
+        pool.join()
 
 def parseArgs():
     parser = ap.ArgumentParser()